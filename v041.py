@@ -16,22 +16,26 @@ except NameError:
   pass ## we're still good
 """
 
+import csv
 import itertools
 import argparse
 from typing import Any
 from functools import partial
 import subprocess
 
+import queue
+import threading
 import zipfile
 import math
 import os
+import random
 
-import einops
+import numpy as np
 import rich
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import nn
-import polars as pl
 import wandb
 
 # This seems like one of the best choices right now for a fast/lightweight/simple tokenizer.
@@ -40,6 +44,11 @@ import tiktoken
 
 print = rich.print
 
+# The net itself runs in bf16, but let the residual fp32 side-paths (CE's internal upcast, eval accumulators) use TF32 tensor cores instead of full-rate fp32
+torch.set_float32_matmul_precision('high')
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 
 ################
 # Introduction #
@@ -91,6 +100,7 @@ hyp = {
             'output_layer': 2.,
         },
         'weight_decay': 2.**4,     # This is the weight decay when the loss = 0., we approach it exponentially. Somewhat slows overfitting.
+        'bf16_stochastic_round': False, # Use torchao's AdamW with stochastically-rounded bf16 updates (requires torchao). Helps convergence on the bf16 weights without fp32 master-weight memory.
         'total_train_steps': 1000, # We can run effectively infinitely, but is 1000 by default for the inference demo. For infinite runs, you can use the saved checkpoints from disk.
         'microbatch': {            # The microbatch scheduler assumes a power law decay schedule for the grad norm, and adjusts the microbatch size (minimum 1) to enforce it.
             'sample_every': 5,     # Sampling grad norm can be a bit expensive, so we do it every n steps instead.
@@ -106,6 +116,9 @@ hyp = {
         'qk_dim_div': 8,
         'expand_factor': 2,
         'num_blocks': round(8 * math.log2(1.+model_scale)),
+        'use_flash': False, # If True, drop the learned position bias entirely so SDPA can take the FlashAttention is_causal fast path (O(L) memory instead of the O(L^2) mask)
+        'activation_checkpointing': False, # Recompute each block's expand->GeGLU->attention region in backward instead of storing it. ~1/3 extra compute for roughly half the activation memory -- worth it when activation-memory-bound (model_scale > 1)
+        'compile_mode': 'default', # 'reduce-overhead' captures the step as a CUDA graph and replays it -- kills per-kernel launch overhead at short sequence lengths, at the cost of a recapture every time the shapes grow
     },
     'misc': {
         'num_tokens': 50304, # Rounded to the nearest value of 64 for efficiency
@@ -206,7 +219,8 @@ else:
     ## This is effectively instantaneous, and takes us practically straight to where the dataloader-loaded dataset would be. :)
     ## So as long as you run the above loading process once, and keep the file on the disc it's specified by default in the above
     ## hyp dictionary, then we should be good. :)
-    data = torch.load(hyp['misc']['data_location'])
+    # map_location pins the tokens straight onto the training device, so batches never cross the PCIe bus at train time
+    data = torch.load(hyp['misc']['data_location'], map_location=hyp['misc']['device'])
 
 
 ########################################
@@ -215,14 +229,17 @@ else:
 
 with torch.no_grad():
     # Create the base arrays for the learnable linear positional bias. This helps save some memory consumption & processing time
-    bias_range                    = torch.arange(-hyp['misc']['sequence_length']['max']+1, 1).to(hyp['misc']['device'], torch.bfloat16)
-    position_bias_base            = bias_range.unsqueeze(0) - bias_range.unsqueeze(1)
-    negative_infinity_matrix_base = torch.empty_like(position_bias_base).fill_(-float("inf"))
-    causal_mask = torch.tril(torch.ones((hyp['misc']['sequence_length']['max'], hyp['misc']['sequence_length']['max']), device=hyp['misc']['device'], dtype=torch.bool))
+    bias_range           = torch.arange(-hyp['misc']['sequence_length']['max']+1, 1, device=hyp['misc']['device'])
+    # Stored as compact int16 relative offsets (max offset is max_seq-1); the bf16 cast happens on the fly in the block and fuses into the mask multiply-add under compile
+    position_bias_base   = (bias_range.unsqueeze(0) - bias_range.unsqueeze(1)).to(torch.int16)
+    causal_mask          = torch.tril(torch.ones((hyp['misc']['sequence_length']['max'], hyp['misc']['sequence_length']['max']), device=hyp['misc']['device'], dtype=torch.bool))
+    # Additive form of the causal mask (0 on/below the diagonal, -inf above), so the attn_mask becomes a fused multiply-add instead of a 3-input select
+    additive_causal_mask = torch.zeros((hyp['misc']['sequence_length']['max'], hyp['misc']['sequence_length']['max']), device=hyp['misc']['device'], dtype=torch.bfloat16).masked_fill_(~causal_mask, -float("inf"))
 
 
-# Used in the dataloader to select indexes in a sequence. Preallocated for slight efficiency.
-batch_index_offsets = torch.arange(0, hyp['misc']['sequence_length']['max']+1, dtype=torch.long, device=hyp['misc']['device'])
+# Zero-copy sliding-window views over the token streams, shape (num_tokens - max_length, max_length + 1).
+# The dataloader just gathers rows from these, no per-batch index arithmetic needed.
+data_windows = {key: tokens.unfold(0, hyp['misc']['sequence_length']['max']+1, 1) for key, tokens in data.items()}
 
 
 #############################################
@@ -238,58 +255,92 @@ class LatentAttentionBlock(nn.Module):
         self.qk_dim     = self.dim//hyp['net']['qk_dim_div']
         self.v_dim      = num_dim
         self.expand_dim = num_dim * hyp['net']['expand_factor']
-        self.linear_value = linear_value 
+        self.linear_value = linear_value
         self.num_heads = num_heads
+        self.use_flash = hyp['net']['use_flash']
+        self.activation_checkpointing = hyp['net']['activation_checkpointing']
 
         # Main layer weights
         self.norm    = nn.LayerNorm(self.dim, bias=False)
-        self.expand  = nn.Parameter(.5 * 1./hyp['net']['residual_depth']**.5 * 1./hyp['net']['expand_factor']                               * torch.randn(2*self.qk_dim+2*self.expand_dim, self.dim))
-        self.project = nn.Parameter(1. * 1./hyp['net']['residual_depth']**.5 * 1./hyp['net']['expand_factor'] * 1./hyp['net']['num_blocks'] * torch.randn((self.dim, self.expand_dim)))
+        # Output columns are laid out as [linear | pre_gelu | query | key] so that the two GeGLU operands land contiguous for the fused pointwise kernel
+        self.expand  = nn.Parameter(.5 * 1./hyp['net']['residual_depth']**.5 * 1./hyp['net']['expand_factor']                               * torch.randn(2*self.expand_dim+2*self.qk_dim, self.dim))
+        # The output projection is stored as two slabs (local GeGLU channels / attention channels) so the forward pass can skip the torch.cat of its inputs
+        self.project_local = nn.Parameter(1. * 1./hyp['net']['residual_depth']**.5 * 1./hyp['net']['expand_factor'] * 1./hyp['net']['num_blocks'] * torch.randn((self.dim, self.expand_dim-self.v_dim)))
+        self.project_attn  = nn.Parameter(1. * 1./hyp['net']['residual_depth']**.5 * 1./hyp['net']['expand_factor'] * 1./hyp['net']['num_blocks'] * torch.randn((self.dim, self.v_dim)))
 
         # Learnable linear positional encodings. Similar to but different than https://arxiv.org/abs/2108.12409
         # Has a high lr mult applied to it so that each layer can learn its own attention scale.
-        self.position_bias_mult = nn.Parameter(torch.tensor(1., device='cuda'))
+        # Omitted entirely with use_flash: any explicit attn_mask disables SDPA's FlashAttention backend.
+        if not self.use_flash:
+            self.position_bias_mult = nn.Parameter(torch.tensor(1., device='cuda'))
+            self.position_bias_mult._param_group = 'position_bias'
 
-    def forward(self, x):
+        # Explicit optimizer-group tags, read by init_param_groups_dict (untagged parameters land in the default 'decay' group)
+        self.norm.weight._param_group = 'non_dot_products'
+
+    def forward(self, x, pos_bias, additive_mask):
         residual = x
 
-        # Make additive attention mask, scaled by a learned mult for the position bias (lets us learn dynamic attention ranges per layer as needed)
-        attn_mask = torch.where(causal_mask[:x.shape[1], :x.shape[1]], F.softplus(self.position_bias_mult) * position_bias_base[:x.shape[1], :x.shape[1]], negative_infinity_matrix_base[:x.shape[1], :x.shape[1]])
+        # With activation checkpointing, the block body (everything but the residual path) is recomputed during backward instead of
+        # keeping its activations around -- trades ~1/3 extra forward compute for roughly half the activation memory, i.e. bigger batches
+        if self.activation_checkpointing:
+            out = torch.utils.checkpoint.checkpoint(self._block_body, x, pos_bias, additive_mask, use_reentrant=False)
+        else:
+            out = self._block_body(x, pos_bias, additive_mask)
+
+        # Add to residual
+        x = residual + out
+
+        return x
+
+    def _block_body(self, x, pos_bias, additive_mask):
+        if self.use_flash:
+            attn_mask = None
+        else:
+            # Make additive attention mask, scaled by a learned mult for the position bias (lets us learn dynamic attention ranges per layer as needed)
+            # The additive causal mask replaces the old torch.where(causal_mask, ..., -inf) select -- one fewer input to read, and the scale folds into a multiply-add
+            # The pos_bias/additive_mask slices are shared across blocks, see SpeedyLangNet.forward -- only the learned scalar differs per block
+            # (the scalar softplus fuses into the multiply-add under torch.compile, so it's free here)
+            attn_mask = F.softplus(self.position_bias_mult) * pos_bias.to(torch.bfloat16) + additive_mask
 
         # Shared LayerNorm for linear layers and attention
         x = self.norm(x)
 
-        # Fused into one kernel for memory+speed/etc
-        query, key, linear, pre_gelu = F.linear(x, self.expand).split((self.qk_dim, self.qk_dim, self.expand_dim, self.expand_dim), dim=-1)
+        # Fused into one kernel for memory+speed/etc. Free slicing views instead of .split so each consumer reads straight from the matmul output
+        projected = F.linear(x, self.expand)
+        linear    = projected[..., :self.expand_dim]
+        pre_gelu  = projected[..., self.expand_dim:2*self.expand_dim]
+        query     = projected[..., 2*self.expand_dim:2*self.expand_dim+self.qk_dim]
+        key       = projected[..., -self.qk_dim:]
 
         # Compute GeGLU (one portion of the channels this will stay locally, another will become the nonlinear value for attention)
         geglu = linear * F.gelu(pre_gelu)
 
-        # Partition between the input values and the v dim values
-        if self.linear_value:
-            geglu_local, _ = geglu.split((self.expand_dim-self.v_dim, self.v_dim), -1)
-            _, geglu_attention_value = pre_gelu.split((self.expand_dim-self.v_dim, self.v_dim), -1)
-        else:
-            geglu_local, geglu_attention_value = geglu.split((self.expand_dim-self.v_dim, self.v_dim), -1)
+        # Partition between the input values and the v dim values. Direct slices instead of .split: same views, fewer Python-level ops
+        geglu_local           = geglu[..., :self.expand_dim-self.v_dim]
+        geglu_attention_value = (pre_gelu if self.linear_value else geglu)[..., -self.v_dim:]
 
         if self.num_heads > 1:
-            query, key, geglu_local, geglu_attention_value = map(lambda x: einops.rearrange(x, 'b n (h d) -> b h n d', h=self.num_heads), (query, key, geglu_local, geglu_attention_value))
+            # Plain reshape/transpose instead of einops.rearrange -- same layout, none of the per-call Python overhead
+            # (reshape rather than view because these are slicing views of the fused projection)
+            batchsize, length = x.shape[0], x.shape[1]
+            split_heads = lambda t: t.reshape(batchsize, length, self.num_heads, -1).transpose(1, 2)
+            query, key, geglu_local, geglu_attention_value = map(split_heads, (query, key, geglu_local, geglu_attention_value))
 
 
         # Compute attention. Something to note is that there are no attention heads here. This seemed to work a bit better, maybe due to not needing memory `.contiguous()` calls or similar
-        attention = F.scaled_dot_product_attention(query, key, geglu_attention_value, attn_mask=attn_mask)
+        # With use_flash, attn_mask is None and is_causal=True selects the FlashAttention backend
+        attention = F.scaled_dot_product_attention(query, key, geglu_attention_value, attn_mask=attn_mask, is_causal=self.use_flash)
 
         if self.num_heads > 1:
-            attention = einops.rearrange(attention, 'b h n d -> b n (h d)')
-            geglu_local = einops.rearrange(geglu_local, 'b h n d -> b n (h d)')
-
-        # Output linear layer
-        out = F.linear(torch.cat([geglu_local, attention], dim=-1), self.project)
+            attention   = attention  .transpose(1, 2).reshape(batchsize, length, -1)
+            geglu_local = geglu_local.transpose(1, 2).reshape(batchsize, length, -1)
 
-        # Add to residual
-        x = residual + out
+        # Output linear layer. Two matmuls plus an add instead of F.linear(torch.cat(...)) -- skips materializing a (B, L, expand_dim) bf16 cat buffer,
+        # and under compile the add fuses into the second matmul's epilogue
+        out = F.linear(geglu_local, self.project_local) + F.linear(attention, self.project_attn)
 
-        return x
+        return out
 
 
 #############################################
@@ -302,11 +353,20 @@ class SpeedyLangNet(nn.Module):
         super().__init__()
         self.net_dict = network_dict
 
+        # Register the (shared) mask tensors as buffers so that torch.compile sees stable module attributes instead of
+        # mutable global reads (which cause guards/graph breaks under fullgraph=True). Non-persistent: they're cheap to rebuild.
+        self.register_buffer('position_bias_base',   position_bias_base,   persistent=False)
+        self.register_buffer('additive_causal_mask', additive_causal_mask, persistent=False)
+
     def forward(self, x):
+        # Slice the shared mask tensors once per step instead of once per block -- only the learned scalar differs between blocks
+        pos_bias      = self.position_bias_base  [:x.shape[1], :x.shape[1]]
+        additive_mask = self.additive_causal_mask[:x.shape[1], :x.shape[1]]
+
         # Look up the input embeddings from the input tokens
         x = self.net_dict['embedding'](x)
         for attn_block in self.net_dict['attn_layers']:
-            x = attn_block(x) # note: residuals are included in the block definitions for these layers
+            x = attn_block(x, pos_bias, additive_mask) # note: residuals are included in the block definitions for these layers
         x = self.net_dict['norm'](x)
         x = self.net_dict['outputs'](x)
         return x
@@ -325,6 +385,9 @@ def make_net(settings: dict[str, Any]):
         'outputs': nn.Linear(settings['width'], hyp['misc']['num_tokens'], bias=False),
 })
     net = SpeedyLangNet(network_dict)
+    # Precision note: the whole net lives in bf16 (weights and activations) instead of using torch.autocast around the forward --
+    # same tensor-core throughput as AMP without fp32 master copies or per-op cast overhead. If pure-bf16 convergence gets
+    # fragile at larger scales, see hyp['opt']['bf16_stochastic_round'] before reaching for autocast.
     net = net.to(hyp['misc']['device'], torch.bfloat16)
     net.train()
 
@@ -332,6 +395,18 @@ def make_net(settings: dict[str, Any]):
     torch.nn.init.normal_(net.net_dict['embedding'].weight.data, std=.25*1./settings['width']**.5)
     torch.nn.init.normal_(net.net_dict['outputs']  .weight.data, std=.5 *1./settings['width']**.5)
 
+    # Explicit optimizer-group tags, read by init_param_groups_dict (untagged parameters land in the default 'decay' group)
+    net.net_dict['embedding'].weight._param_group = 'non_dot_products'
+    net.net_dict['norm']     .weight._param_group = 'non_dot_products'
+    net.net_dict['outputs']  .weight._param_group = 'output'
+
+    # Compile so that Inductor can fuse the pointwise ops (GeGLU, mask construction, residual adds) into single kernels.
+    # The default mode tolerates the growing sequence lengths; switch hyp['net']['compile_mode'] to 'reduce-overhead' for CUDA-graph replay of the step.
+    try:
+        net = torch.compile(net, mode=hyp['net']['compile_mode'], fullgraph=True, dynamic=True)
+    except Exception as compile_error:
+        print(f"torch.compile failed ({compile_error}), continuing in eager mode")
+
     return net
 
 
@@ -339,12 +414,24 @@ def make_net(settings: dict[str, Any]):
 #          Training Helpers            #
 ########################################
 
+def compile_or_eager(fn):
+    # Same eager fallback as in make_net -- on setups where torch.compile is unsupported (e.g. a too-new Python),
+    # a bare module-level @torch.compile would raise at import time, before make_net's try/except can even run
+    try:
+        return torch.compile(fn, mode='default', dynamic=True)
+    except Exception as compile_error:
+        print(f"torch.compile failed for {fn.__name__} ({compile_error}), continuing in eager mode")
+        return fn
+
 # Get a single batch item. Currently used in the training loop
+# Compiled so the randint, the row gather, and the slicing turn into one fused kernel instead of 4-5 small launches (dynamic: batchsize/length change over training)
+@compile_or_eager
 @torch.no_grad()
-def get_batch(data_dict, key, batchsize, length):
-    start_indexes     = torch.randint(len(data_dict[key])-length-1, (batchsize,), device=hyp['misc']['device']) # warning, completely random sampling, not a random derangement, that might help performance a bit!
-    sequence_indexes  = start_indexes.unsqueeze(-1) + batch_index_offsets[:length+1].unsqueeze(0) # slice, as batch_index_offsets are pre-allocated to max length for efficiency
-    sampled_sequences = torch.take_along_dim(data_dict[key], sequence_indexes.flatten(), dim=0).view(batchsize, length+1).long() # have to flatten and reshape due to take_along_dim being 1d
+def get_batch(windows_dict, key, batchsize, length):
+    windows           = windows_dict[key]
+    start_indexes     = torch.randint(windows.shape[0], (batchsize,), device=hyp['misc']['device']) # warning, completely random sampling, not a random derangement, that might help performance a bit!
+    sampled_sequences = windows[start_indexes, :length+1] # single coalesced gather from the pre-made strided window view, no index materialization needed
+    # note: stays int32 -- the embedding gather accepts that directly, and only the loss targets need an int64 upcast (done at the loss call)
 
     inputs, targets  = sampled_sequences[:, :-1], sampled_sequences[:, 1:] # reslice to get our input tokens and our shifted-by-1 targets
 
@@ -378,35 +465,27 @@ def init_param_groups_dict(net, base_lr):
 
     print("scaled lr:          ", "{:0.8f}".format(scaled_lr))
 
-    # Decay is the default dictionary if there is no parameter name match
-    param_groups['decay']                     = {'params': [], 'lr': scaled_lr,                                           'eps': 1e-9, 'betas': (.9,  .95), 'weight_decay': hyp['opt']['weight_decay'],  'scheduler': infinite_powah        }
-    param_groups['position_bias_mult']        = {'params': [], 'lr': hyp['opt']['lr_mult']['position_bias']   *scaled_lr, 'eps': 1e-9, 'betas': (.9,  .95), 'weight_decay': 0,                           'scheduler': pos_bias_decay_lr     }
-    param_groups['norm', 'bias', 'embedding'] = {'params': [], 'lr': hyp['opt']['lr_mult']['non_dot_products']*scaled_lr, 'eps': 1e-9, 'betas': (.9,  .95), 'weight_decay': 0,                           'scheduler': infinite_powah        }
-    param_groups['output']                    = {'params': [], 'lr': hyp['opt']['lr_mult']['output_layer']    *scaled_lr, 'eps': 1e-9, 'betas': (.6,  .95), 'weight_decay': 0,                           'scheduler': infinite_powah_outputs}
-
-    # Helper functions for matching parameters to dictionary keys
-    in_list  = lambda name, keyword_list: any(keyword in name for keyword in keyword_list)
-    to_tuple = lambda x: x if type(x) == tuple else (x,)
+    # Decay is the default group for parameters without an explicit tag, and is the only group with weight decay.
+    param_groups['decay']            = {'params': [], 'lr': scaled_lr,                                           'eps': 1e-9, 'betas': (.9,  .95), 'weight_decay': hyp['opt']['weight_decay'],  'scheduler': infinite_powah        }
+    param_groups['position_bias']    = {'params': [], 'lr': hyp['opt']['lr_mult']['position_bias']   *scaled_lr, 'eps': 1e-9, 'betas': (.9,  .95), 'weight_decay': 0,                           'scheduler': pos_bias_decay_lr     }
+    param_groups['non_dot_products'] = {'params': [], 'lr': hyp['opt']['lr_mult']['non_dot_products']*scaled_lr, 'eps': 1e-9, 'betas': (.9,  .95), 'weight_decay': 0,                           'scheduler': infinite_powah        }
+    param_groups['output']           = {'params': [], 'lr': hyp['opt']['lr_mult']['output_layer']    *scaled_lr, 'eps': 1e-9, 'betas': (.6,  .95), 'weight_decay': 0,                           'scheduler': infinite_powah_outputs}
 
-    # In order, search through the dictionary keys, and add to that dictionary if a value in the dictionary key matches the name.
-    # 'decay' is the name of the default group, and is the only group with weight decay.
-    for name, p in net.named_parameters():
+    # Parameters carry an explicit _param_group tag from construction, so there's no substring matching on names
+    # (which could silently misroute any future parameter that happens to contain e.g. 'norm' in its name).
+    for p in net.parameters():
         if p.requires_grad:
-            target_param_dict = next(iter([k for k in param_groups.keys() if in_list(name, to_tuple(k))]), 'decay')
-            param_groups[target_param_dict]['params'].append(p)
+            param_groups[getattr(p, '_param_group', 'decay')]['params'].append(p)
 
     return param_groups
 
 
 def get_grad_norm(net):
-    # Gets the entire grad norm of the network.
-    grad_norm = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float64)
-    for p in net.parameters():
-        if p.grad is not None:
-            param_norm = p.grad.detach().data.norm(2)
-            grad_norm += param_norm.square()
-    grad_norm = (grad_norm ** 0.5).item()
-    return grad_norm
+    # Gets the entire grad norm of the network. One fused multi-tensor kernel plus a single reduction instead of a reduction kernel per parameter.
+    # Returns a 0-dim CUDA tensor -- callers decide when (and whether) to pay the host sync.
+    grads     = [p.grad for p in net.parameters() if p.grad is not None]
+    per_tensor_norms = torch._foreach_norm(grads, 2.)
+    return torch.linalg.vector_norm(torch.stack(per_tensor_norms).float(), 2.)
 
 
 def grow_sequence_length(old_length, old_batchsize):
@@ -442,15 +521,58 @@ def print_training_details(columns_list, separator_left='  ', separator_right='
 
 
 # The previous function was a shorter but slightly more heinous lambda, however, this may still cause you some pain. <3 :'(
-def format_for_table(var_list, locals):
-    int_format     = lambda x: f"{locals[x]}".rjust(len(x))
-    default_format = lambda x: f"{locals[x]:0.4f}".rjust(len(x)) if len(f"{locals[x]:0.4f}") < 8 else f"{locals[x]:.4f}"[:8].rjust(len(x))
-    blank_format   = lambda x: " "*len(x)
-
-    out_list = [blank_format(v) if v not in locals else (int_format(v) if type(locals[v]) == int else default_format(v)) for v in var_list]
+# Column widths are static, so they're computed once here instead of re-deriving them (and rebuilding three formatter lambdas) on every call.
+column_widths = {name: len(name) for name in variables_to_log}
+
+def format_for_table(var_list, values):
+    out_list = []
+    for v in var_list:
+        width = column_widths[v]
+        if v not in values:
+            out_list.append(" " * width)
+        elif type(values[v]) == int:
+            out_list.append(f"{values[v]}".rjust(width))
+        else:
+            formatted = f"{values[v]:0.4f}"
+            out_list.append(formatted.rjust(width) if len(formatted) < 8 else formatted[:8].rjust(width))
     return out_list
 
 
+class LogBuffer:
+    """Preallocated numeric series for run statistics. Grows by doubling like a list, but each append is a single numpy slot
+    write (no per-element PyObject boxing) and the end-of-run conversion is one vectorized tolist. float64 holds the logged
+    ints (tokens_seen etc.) exactly."""
+    def __init__(self, initial_capacity: int = 4096):
+        self.data   = np.empty(initial_capacity, dtype=np.float64)
+        self.length = 0
+
+    def append(self, value):
+        if self.length == len(self.data):
+            self.data = np.concatenate((self.data, np.empty_like(self.data)))
+        self.data[self.length] = value
+        self.length += 1
+
+    def tolist(self) -> list:
+        return self.data[:self.length].tolist()
+
+
+def start_wandb_logger() -> queue.Queue:
+    # wandb.log serializes its dict on the calling thread; push that work onto a daemon thread so the training loop never blocks on it.
+    # Everything put on the queue must already be plain Python scalars -- no CUDA tensors.
+    log_queue = queue.Queue()
+    def _worker():
+        while True:
+            metrics = log_queue.get()
+            try:
+                wandb.log(metrics)
+            except Exception as log_error:
+                print(f"wandb.log failed ({log_error}), dropping this batch of metrics")
+            finally:
+                log_queue.task_done() # must run even on failure, otherwise log_queue.join() at the end of training hangs forever
+    threading.Thread(target=_worker, daemon=True).start()
+    return log_queue
+
+
 def format_num_params(num_params: int, round_to_digits: int = 1) -> str:
     if num_params < 1_000:
         pnum = str(round(num_params, max(0, round_to_digits)))
@@ -482,6 +604,12 @@ def format_num_params(num_params: int, round_to_digits: int = 1) -> str:
 def calc_pplx(loss: torch.Tensor | float) -> torch.Tensor | float:
     return 2.71828 ** loss
 
+# Compiled so argmax -> compare -> mean fuse into one kernel instead of three launches with materialized bool/float intermediates
+@compile_or_eager
+@torch.no_grad()
+def calc_acc(outputs: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+    return (outputs.argmax(-1) == targets).float().mean()
+
 def eval(net):
     ####################
     # Evaluation  Mode #
@@ -493,20 +621,27 @@ def eval(net):
     num_eval_sequences       = hyp['opt']['num_eval_tokens']//hyp['misc']['sequence_length']['max']
     num_eval_steps           = num_eval_sequences//eval_batchsize
 
-    # float32 here to prevent truncation errors
-    val_loss, val_acc = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float), torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
+    # float32 here to prevent truncation errors. Accumulate in sum-form and divide once at the end instead of launching a tiny scale kernel per step
+    val_loss    = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
+    num_correct = torch.tensor(0., device=hyp['misc']['device'], dtype=torch.float)
+    num_targets = 0
 
-    with torch.no_grad():
+    with torch.inference_mode():
         # Note: We eval at the maximum sequence length so that we can get an idea of how well the sequence length growing extrapolates out
         for _ in range(num_eval_steps):
-            inputs, targets = get_batch(data, key='eval', batchsize=eval_batchsize, length=hyp['misc']['sequence_length']['max'])
+            inputs, targets = get_batch(data_windows, key='eval', batchsize=eval_batchsize, length=hyp['misc']['sequence_length']['max'])
             outputs = net(inputs)
-            val_loss += 1./num_eval_steps * loss_fn(outputs.flatten(0, 1).float(), targets.flatten(0, 1))
-            val_acc  += 1./num_eval_steps * (outputs.argmax(-1) == targets).float().mean()
+            # CE upcasts bf16 logits internally and reduces in fp32, so no need to materialize a full fp32 copy of the (B*L, vocab) logits here
+            val_loss    += loss_fn(outputs.view(-1, outputs.shape[-1]), targets.reshape(-1).long())
+            num_correct += (outputs.argmax(-1) == targets).sum()
+            num_targets += targets.numel()
 
-        val_pplx = calc_pplx(val_loss)
+        val_loss /= num_eval_steps
+        val_acc   = num_correct / num_targets
+        val_pplx  = calc_pplx(val_loss)
 
-    return val_acc.item(), val_loss.item(), val_pplx.item()
+    # The whole eval loop accumulates on-GPU; this is its single host-device sync
+    return torch.stack((val_acc, val_loss, val_pplx)).tolist()
 
 
 def train(net: SpeedyLangNet | None = None, **settings):
@@ -521,10 +656,18 @@ def train(net: SpeedyLangNet | None = None, **settings):
     # Init wandb 
     if settings['log_wandb']:
         wandb.finish()  # Finish any previous runs
+        # wandb's system-metrics collector and console capture preempt the training loop every few seconds; we only want our own metrics
+        os.environ['WANDB_CONSOLE'] = 'off'
+        try:
+            wandb_settings = wandb.Settings(x_disable_stats=True, x_disable_meta=True)
+        except Exception: # older wandb releases only know the underscore-prefixed spelling
+            wandb_settings = wandb.Settings(_disable_stats=True, _disable_meta=True)
         wandb.init(
-            project=settings['wandb_project'], 
+            project=settings['wandb_project'],
             config=settings,
+            settings=wandb_settings,
         )
+        log_queue = start_wandb_logger()
 
     # Full-run statistics variables
     t_secs        = 0.
@@ -580,19 +723,32 @@ def train(net: SpeedyLangNet | None = None, **settings):
     # Bit of a strange approximation, but this seemed
     microbatch_grad_norm_steps_scale = math.log(total_trainable_params) * total_trainable_params
 
+    # Hoisted constant factor of the per-step grad-norm target, so the loop only exponentiates the step count.
+    # (A full precomputed per-step table isn't practical here: runs are usually epoch/token/time-bound with max_steps defaulting to 1e9.)
+    microbatch_grad_norm_target_scale = microbatch_grad_norm_steps_scale ** microbatch_expected_grad_norm_pow
+
+    # Cached reciprocal sqrt of the param count for the per-param grad norm -- turns a pow+div in the loop into one multiply
+    inv_sqrt_trainable_params = 1. / total_trainable_params**.5
+
     # Create multiple parameter groups based on parameter name, as certain kinds of parameters seem to work best
     # with specific combinations of learning rates and schedulers
     param_groups_dict = init_param_groups_dict(net, base_lr)
-    opt               = torch.optim.AdamW(param_groups_dict.values(), fused=True)
+    if hyp['opt']['bf16_stochastic_round']:
+        # Optional dependency, imported lazily so the default path doesn't need torchao installed.
+        # Stochastic rounding on the bf16 weight updates avoids the tiny-update truncation that can stall pure-bf16 Adam late in training.
+        from torchao.prototype.low_bit_optim import _AdamW
+        opt           = _AdamW(param_groups_dict.values(), bf16_stochastic_round=True)
+    else:
+        opt           = torch.optim.AdamW(param_groups_dict.values(), fused=True, capturable=True) # capturable keeps the step state on-device, so the step can live inside a CUDA graph under compile
     scheduler         = torch.optim.lr_scheduler.LambdaLR(opt, [k['scheduler'] for k in param_groups_dict.values()])
 
-    # Save some results
-    train_losses, val_losses, train_accs, val_accs, train_pplxs, val_pplxs = [], [], [], [], [], []
-    grad_norms, cumulative_time = [], []
-    tokens_seen_list, epochs_list = [], []
-    batch_sizes = []
-    sequence_lengths = []
-    learning_rates, weight_decays = [], []
+    # Save some results (preallocated buffers instead of Python lists; converted to lists once at return)
+    train_losses, val_losses, train_accs, val_accs, train_pplxs, val_pplxs = LogBuffer(), LogBuffer(), LogBuffer(), LogBuffer(), LogBuffer(), LogBuffer()
+    grad_norms, cumulative_time = LogBuffer(), LogBuffer()
+    tokens_seen_list, epochs_list = LogBuffer(), LogBuffer()
+    batch_sizes = LogBuffer()
+    sequence_lengths = LogBuffer()
+    learning_rates, weight_decays = LogBuffer(), LogBuffer()
 
     #################
     # Training Mode #
@@ -612,11 +768,15 @@ def train(net: SpeedyLangNet | None = None, **settings):
 
     # Main loop. Most of the complexity here is in the dynamic growing scheduler(s).
     while True:
-        inputs, targets = get_batch(data, key='train', batchsize=curr_batchsize, length=curr_length)
+        inputs, targets = get_batch(data_windows, key='train', batchsize=curr_batchsize, length=curr_length)
+
+        # Both dims change in lockstep every growth_steps (length doubles, batchsize halves) -- tell Dynamo up front so each doubling doesn't retrace the graph
+        torch._dynamo.mark_dynamic(inputs, 0)
+        torch._dynamo.mark_dynamic(inputs, 1)
 
         outputs = net(inputs)
 
-        loss = loss_fn(outputs.flatten(0, 1), targets.flatten(0, 1))
+        loss = loss_fn(outputs.flatten(0, 1), targets.flatten(0, 1).long())
 
         loss.div(discrete_sampled_microbatch_steps).backward()
         tokens_seen += curr_batchsize * curr_length
@@ -635,14 +795,15 @@ def train(net: SpeedyLangNet | None = None, **settings):
 
         # Quick non-eval summary every N training steps, at the end of every microbatch group, including when we are not doing a _full eval_ here so that the resulting stats are complete
         if do_eval:
-            train_acc          = (outputs.detach().argmax(-1) == targets).float().mean().item()
-            train_loss         = loss.detach().cpu().item()
+            # Materialize the step's GPU scalars with a single transfer instead of a blocking .item() per metric
+            train_acc_gpu = calc_acc(outputs.detach(), targets)
+            train_loss, train_acc, grad_norm = torch.stack((loss.detach().float(), train_acc_gpu, get_grad_norm(net))).tolist()
 
-            grad_norm = get_grad_norm(net)
+            train_pplx = float(calc_pplx(train_loss))  # unnecessary float, but better safe than sorry. Computed once here, reused by the wandb dict below
 
             train_losses.append(train_loss)
             train_accs.append(train_acc)
-            train_pplxs.append(float(calc_pplx(train_loss)))  # unnecessary float, but better safe than sorry
+            train_pplxs.append(train_pplx)
             grad_norms.append(grad_norm)
             tokens_seen_list.append(tokens_seen)
             epochs_list.append(epoch)
@@ -660,7 +821,8 @@ def train(net: SpeedyLangNet | None = None, **settings):
 
             # Dynamic weight decay scheduling. Based upon something similar to the reciprocal of the perplexity of the network over the data [inspired by section 5 of https://arxiv.org/pdf/2204.02311.pdf]
             # Smaller models have a higher base, and weight decay kicks in more sharply later. For larger models, it activates more early
-            opt.param_groups[0]['weight_decay'] = 1./weight_decay_pow_base**(loss.detach()+1e-8).item() * hyp['opt']['weight_decay']
+            # Reuses the loss materialized by the logging branch: it drifts negligibly within 10 steps, and a fresh .item() here would sync the device every single step
+            opt.param_groups[0]['weight_decay'] = 1./weight_decay_pow_base**(train_loss+1e-8) * hyp['opt']['weight_decay']
             scheduler.step()
 
             # Check if we need to double our sequence length
@@ -670,10 +832,10 @@ def train(net: SpeedyLangNet | None = None, **settings):
             # The next several lines calculate a dynamic batchsize, simulated through manual dithering
             # There could be improvements or losses in changing the dithering strategy, since determinism and gradient descent can lead to some very not-so-nice (and subtle) loss oscillations.
             if curr_step % hyp['opt']['microbatch']['sample_every'] == 0:
-                grad_norm = get_grad_norm(net)
+                grad_norm = get_grad_norm(net).item() # the microbatch schedule below runs in Python floats, so this sync is unavoidable (but only every sample_every steps)
 
-                grad_norm_per_param = grad_norm/(total_trainable_params**.5) # This should keep the expected grad norm per parameter roughly the same (ignoring initializations) unless I did my napkin math wrong (feel free to correct it and test it out if so! <3 :') )
-                grad_norm_target    = (((microbatch_grad_norm_steps_scale * (curr_step + 1e-2))) ** microbatch_expected_grad_norm_pow)
+                grad_norm_per_param = grad_norm * inv_sqrt_trainable_params # This should keep the expected grad norm per parameter roughly the same (ignoring initializations) unless I did my napkin math wrong (feel free to correct it and test it out if so! <3 :') )
+                grad_norm_target    = microbatch_grad_norm_target_scale * (curr_step + 1e-2) ** microbatch_expected_grad_norm_pow
                 ratio_diff          = grad_norm_per_param/(grad_norm_target)
 
                 # Update the fractional number of steps based on the % difference between the grad norm and expected grad norm.
@@ -684,9 +846,9 @@ def train(net: SpeedyLangNet | None = None, **settings):
             base, dither_prob = divmod(microbatch_steps, 1)
 
             # Randomly sample next accumulate steps to use. This is the dithered operation, the 'microbatch_steps' is the noninteger accumulator between steps.
-            discrete_sampled_microbatch_steps = max(1, int(base + torch.bernoulli(torch.tensor(dither_prob)).item())) # bernoulli via torch to save an unnecesary import :)
+            discrete_sampled_microbatch_steps = max(1, int(base) + (1 if random.random() < dither_prob else 0)) # CPU-side bernoulli -- a torch draw here would allocate a tensor and force a device sync for one bit
 
-            opt.zero_grad()
+            opt.zero_grad(set_to_none=True) # drop the grad tensors instead of writing zeros into each one (get_grad_norm runs before this and handles grad=None)
 
             # reset microbatch steps and increment current step
             curr_microbatch_step = 0
@@ -697,9 +859,11 @@ def train(net: SpeedyLangNet | None = None, **settings):
             torch.cuda.synchronize()
 
             t_secs += 1e-3 * starter.elapsed_time(ender)
-            train_loss = loss.detach().cpu().item() # Update the loss for the training details printout
+            # (train_loss is already materialized by the stats block above -- same loss tensor, same iteration -- so no second .item() here)
 
             net.eval()
+            # Eval runs on the default stream: the table prints val metrics at this same boundary, and eval() ends with a host-side readout
+            # anyway, so a side stream buys no overlap here while giving the caching allocator a second per-stream memory pool.
             val_acc, val_loss, val_pplx = eval(net)
 
             val_losses.append(val_loss)
@@ -707,10 +871,10 @@ def train(net: SpeedyLangNet | None = None, **settings):
             val_pplxs.append(val_pplx)
             
             if settings['log_wandb']:
-                wandb.log({
+                log_queue.put({
                     'train/loss': train_loss,
                     'train/acc': train_acc,
-                    'train/pplx': calc_pplx(train_loss),
+                    'train/pplx': train_pplx,
                     'val/loss': val_loss, 
                     'val/acc': val_acc, 
                     'val/pplx': val_pplx, 
@@ -725,21 +889,30 @@ def train(net: SpeedyLangNet | None = None, **settings):
 
             # Print out our training details
             ## We also check to see if we're on our final eval loop (assum that max_curr_step lines up with the eval_every value) so we can print the 'bottom' of the table for each round.
-            print_training_details(format_for_table(variables_to_log, locals=locals()), is_final_entry=stop_run)
+            ## An explicit dict of plain Python scalars instead of locals() -- snapshotting the whole frame is slow and keeps any CUDA tensors in it alive until the print returns.
+            summary = {
+                'epoch': epoch, 'curr_step': curr_step, 'train_loss': train_loss, 'val_loss': val_loss,
+                'val_pplx': val_pplx, 'train_acc': train_acc, 'val_acc': val_acc, 'grad_norm': grad_norm,
+                'microbatch_steps': microbatch_steps, 't_secs': t_secs,
+            }
+            print_training_details(format_for_table(variables_to_log, values=summary), is_final_entry=stop_run)
 
-            torch.cuda.synchronize()
+            # No synchronize needed before re-arming the timer: event record is sequenced on the stream, so it lands after all queued eval work anyway
             starter.record()
             net.train()
         curr_microbatch_step += 1
         if stop_run:
             break
 
+    if settings['log_wandb']:
+        log_queue.join() # make sure the background thread has handed everything to wandb before the run ends
+
     return (
         net, val_loss,
-        train_losses, val_losses, train_accs, val_accs, train_pplxs, val_pplxs, 
-        grad_norms, cumulative_time, 
-        tokens_seen_list, epochs_list,
-        batch_sizes, sequence_lengths, learning_rates, weight_decays,
+        train_losses.tolist(), val_losses.tolist(), train_accs.tolist(), val_accs.tolist(), train_pplxs.tolist(), val_pplxs.tolist(),
+        grad_norms.tolist(), cumulative_time.tolist(),
+        tokens_seen_list.tolist(), epochs_list.tolist(),
+        batch_sizes.tolist(), sequence_lengths.tolist(), learning_rates.tolist(), weight_decays.tolist(),
     )
 
 
@@ -1004,6 +1177,7 @@ def main():
 
             # Seed
             torch.manual_seed(seed)
+            random.seed(seed) # the microbatch dithering draws from Python's RNG
 
             # Train
             (
@@ -1037,47 +1211,46 @@ def main():
             # You can do whatever you want with your net here; I delete it to save VRAM
             del net 
 
-            # Save results
+            # Save results. One row per run, written with the stdlib csv module -- spinning up a polars DataFrame for a single row is pure overhead.
             results = {
-                "last_val_loss": [last_val_loss],
-                "model_scale": [model_scale],
-                "depth": [hyp['net']['num_blocks']],
-                "width": [hyp['net']['residual_depth']],
-                "num_params": [num_params],
-                "num_non_embedding_params": [num_non_embedding_params],
-                "num_heads": [num_heads],
-                "linear_value": [linear_value],
-                "seed": [seed],
-                "run_num": [run_num+1],
-                "max_epochs": [args.max_epochs],
-                "max_steps": [args.max_steps],
-                "max_tokens": [args.max_tokens],
-                "max_time_seconds": [args.max_time_seconds],
-                "gpu_capacity_scalar": [args.gpu_capacity_scalar],
-                "train_loss": [str(train_losses)],
-                "val_loss": [str(val_losses)],
-                "train_acc": [str(train_accs)],
-                "val_acc": [str(val_accs)],
-                "train_pplx": [str(train_pplxs)],
-                "val_pplx": [str(val_pplxs)],
-                "grad_norm": [str(grad_norms)],
-                "cumulative_time": [str(cumulative_times)],
-                "tokens_seen": [str(tokens_seen_list)],
-                "epoch": [str(epochs_list)],
-                "batch_size": [str(batch_sizes)],
-                "seq_length": [str(sequence_lengths)],
-                "learning_rate": [str(learning_rates)],
-                "weight_decay": [str(weight_decays)],
+                "last_val_loss": last_val_loss,
+                "model_scale": model_scale,
+                "depth": hyp['net']['num_blocks'],
+                "width": hyp['net']['residual_depth'],
+                "num_params": num_params,
+                "num_non_embedding_params": num_non_embedding_params,
+                "num_heads": num_heads,
+                "linear_value": linear_value,
+                "seed": seed,
+                "run_num": run_num+1,
+                "max_epochs": args.max_epochs,
+                "max_steps": args.max_steps,
+                "max_tokens": args.max_tokens,
+                "max_time_seconds": args.max_time_seconds,
+                "gpu_capacity_scalar": args.gpu_capacity_scalar,
+                "train_loss": str(train_losses),
+                "val_loss": str(val_losses),
+                "train_acc": str(train_accs),
+                "val_acc": str(val_accs),
+                "train_pplx": str(train_pplxs),
+                "val_pplx": str(val_pplxs),
+                "grad_norm": str(grad_norms),
+                "cumulative_time": str(cumulative_times),
+                "tokens_seen": str(tokens_seen_list),
+                "epoch": str(epochs_list),
+                "batch_size": str(batch_sizes),
+                "seq_length": str(sequence_lengths),
+                "learning_rate": str(learning_rates),
+                "weight_decay": str(weight_decays),
             }
-            df = pl.DataFrame(results)
-
 
             if args.log_csv:
-                if not os.path.exists(args.logfile) or ((not args.append) and (run_num == setting_num == 0)):
-                    df.write_csv(args.logfile)
-                else:
-                    with open(args.logfile, 'ab') as f:
-                        df.write_csv(f, include_header=False)
+                write_header = not os.path.exists(args.logfile) or ((not args.append) and (run_num == setting_num == 0))
+                with open(args.logfile, 'w' if write_header else 'a', newline='') as f:
+                    writer = csv.writer(f)
+                    if write_header:
+                        writer.writerow(results.keys())
+                    writer.writerow(results.values())
 
             seed += 1
 